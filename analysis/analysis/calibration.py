@@ -65,6 +65,7 @@ def calibration(
         set_voltages, peak_heights,
         std_x=std_x,
         std_y=peak_stds,
+        jac=fitting.poly1_jac,
         debug=True
     )
     coeff = np.array([fit[0][0], fit[0][1]])
@@ -109,6 +110,7 @@ def calibration(
         mca_peak_inds, charges,
         std_x=mca_peak_inds * mca_diff_nonlin,
         std_y=charges_std,
+        jac=fitting.poly1_jac,
         debug=True
     )
     coeff = fit[0]
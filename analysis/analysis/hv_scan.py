@@ -293,6 +293,7 @@ def hv_scan_resolution(ax: plt.Axes, voltages: np.ndarray, fits: tp.List[type_hi
         fitting.poly2,
         voltages,
         rel_fwhms,
+        jac=fitting.poly2_jac,
     )
     fit_x = np.linspace(np.min(voltages), np.max(voltages), 1000)
     fit_eval = fitting.poly2(fit_x, *fit[0])
@@ -1,24 +1,54 @@
+import functools
 import os.path
+import typing as tp
 
 import matplotlib.pyplot as plt
+from matplotlib.ticker import FuncFormatter
 import numpy as np
-from pandas.io.parsers import read_csv
-from scipy.interpolate import interp1d
+import pandas as pd
+from scipy.interpolate import CubicSpline
 from scipy.optimize import curve_fit
 
+import fitting
 import plot
 
 DATA_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
 PREAMP_FOLDER = os.path.join(DATA_FOLDER, "preamp")
 
 
+@functools.lru_cache(maxsize=None)
+def read_columns(path: str, columns: tp.Tuple[str, ...]) -> tp.Tuple[np.ndarray, ...]:
+    """Read numeric columns of a CSV file as float64 arrays
+
+    The results are cached, so the same file is parsed only once per run.
+    The arrays are read-only, so that they cannot be modified in the cache by accident.
+    """
+    data = pd.read_csv(
+        path,
+        usecols=columns,
+        dtype={column: np.float64 for column in columns},
+        engine="c",
+        low_memory=False
+    )
+    arrays = tuple(data[column].to_numpy() for column in columns)
+    for arr in arrays:
+        arr.flags.writeable = False
+    return arrays
+
+
+@functools.lru_cache(maxsize=8)
+def cubic_spline(x: tp.Tuple[float, ...], y: tp.Tuple[float, ...]) -> CubicSpline:
+    """Cubic spline through the given points
+
+    The points are given as tuples so that they can be used as cache keys.
+    """
+    return CubicSpline(x, y, bc_type="not-a-knot")
+
+
 def analyze_attenuator(
         path: str = os.path.join(DATA_FOLDER, "attenuator_test.csv"),
         fig_titles: bool = True) -> np.ndarray:
-    data = read_csv(path)
-    att_setting = data["Attenuation setting"]
-    a_in = data["Input A (V)"]
-    a_out = data["Output A (V)"]
+    att_setting, a_in, a_out = read_columns(path, ("Attenuation setting", "Input A (V)", "Output A (V)"))
     attenuation = a_out / a_in
 
     print("Attenuation:")
@@ -28,18 +58,19 @@ def analyze_attenuator(
     if fig_titles:
         fig.suptitle("Attenuator calibration")
     ax: plt.Axes = fig.add_subplot()
-    ax.scatter(att_setting, attenuation, color="k", zorder=2)
+    ax.plot(att_setting, attenuation, "o", color="k", zorder=2)
     fit = curve_fit(
-        lambda x, a, b: a*x + b,
+        fitting.poly1,
         att_setting,
-        attenuation
+        attenuation,
+        jac=fitting.poly1_jac
     )
     coeff = fit[0]
-    coeff_stds = np.array([fit[1][0, 0], fit[1][1, 1]])
+    coeff_stds = np.sqrt(np.diag(fit[1]))
     ax.plot(
         att_setting,
-        np.polyval(coeff, att_setting),
-        label=f"fit (y = {coeff[0]:.3e}±{coeff_stds[1]:.3e}x + {coeff[1]:.3e}±{coeff_stds[1]:.3e})",
+        fitting.poly1(att_setting, *coeff),
+        label=f"fit (y = {coeff[0]:.3e}±{coeff_stds[0]:.3e}x + {coeff[1]:.3e}±{coeff_stds[1]:.3e})",
         color="tab:blue",
         zorder=1
     )
@@ -56,21 +87,22 @@ def analyze_attenuator(
 def analyze_preamp_freq_response(
         path: str = os.path.join(PREAMP_FOLDER, "preamp_frequency_response.csv"),
         fig_titles: bool = True):
-    data = read_csv(path)
-    f = data["f (Hz)"].to_numpy()
-    a_in = data["Input A (V)"].to_numpy()
-    a_out = data["Output A (V)"].to_numpy()
+    f, a_in, a_out = read_columns(path, ("f (Hz)", "Input A (V)", "Output A (V)"))
     gain = a_out / a_in
-    spline = interp1d(f, gain, kind="cubic")
-    f_axis = np.linspace(f[0], f[-1], 1000)
+    spline = cubic_spline(tuple(f), tuple(gain))
+    # A few points between each pair of data points are enough to show the curvature of the spline
+    points_per_interval = 5
+    f_axis = np.append(np.linspace(f[:-1], f[1:], points_per_interval, endpoint=False).T.ravel(), f[-1])
 
     x_mult = 1e-3
     fig: plt.Figure = plt.figure()
     if fig_titles:
         fig.suptitle("Frequency response of the pre-amplifier")
     ax: plt.Axes = fig.add_subplot()
-    ax.scatter(f*x_mult, gain, label="data", color="k", zorder=2)
-    ax.plot(f_axis * x_mult, spline(f_axis), label="cubic spline", zorder=1)
+    ax.plot(f, gain, "o", label="data", color="k", zorder=2)
+    ax.plot(f_axis, spline(f_axis), label="cubic spline", zorder=1)
+    # The data is plotted in Hz, and only the tick labels are converted to kHz
+    ax.xaxis.set_major_formatter(FuncFormatter(lambda x, pos: f"{x*x_mult:g}"))
 
     ax.set_xlabel("Frequency (kHz)")
     ax.set_ylabel("Gain")
@@ -82,10 +114,7 @@ def analyze_preamp_gain(
         attenuation,
         path: str = os.path.join(PREAMP_FOLDER, "gain_test.csv"),
         fig_titles: bool = True):
-    data = read_csv(path)
-    att_setting = data["Attenuation setting"].to_numpy()
-    a_in = data["Input A (V)"].to_numpy()
-    a_out = data["Output A (V)"].to_numpy()
+    att_setting, a_in, a_out = read_columns(path, ("Attenuation setting", "Input A (V)", "Output A (V)"))
     att_a_in = a_in * attenuation
 
     valid_inds = att_a_in != 0
@@ -101,7 +130,7 @@ def analyze_preamp_gain(
     if fig_titles:
         fig.suptitle("Pre-amplifier gain")
     ax: plt.Axes = fig.add_subplot()
-    ax.scatter(att_a_in, gain, color="k")
+    ax.plot(att_a_in, gain, "o", color="k")
     ax.set_xlabel("Attenuated input amplitude (V)")
     ax.set_ylabel("Gain")
     plot.save_fig(fig, "preamp_gain")
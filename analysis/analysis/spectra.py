@@ -87,7 +87,7 @@ def spectra(
         cal_xerr = np.sqrt([fit_am[1][1, 1], fit_fe[0][1][1, 1], fit_fe[1][1][1, 1]])
         print("Energy calibration x errors:")
         print(cal_xerr)
-        fit = fitting.fit_odr(fitting.poly1, cal_x, cal_y, std_x=cal_xerr)
+        fit = fitting.fit_odr(fitting.poly1, cal_x, cal_y, std_x=cal_xerr, jac=fitting.poly1_jac)
 
         a = fit[0][0]
         b = fit[0][1]
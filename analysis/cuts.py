@@ -0,0 +1,54 @@
+"""
+Cuts for fitting to MCA peaks
+"""
+
+import typing as tp
+
+import numpy as np
+
+from jit import njit
+
+# Adjusting these may result in failed fits
+THRESHOLD_LEVEL = 0.5
+CUT_WIDTH_MULT = 1.7
+
+
+@njit
+def get_cut(
+        data: np.ndarray,
+        threshold_level: float = THRESHOLD_LEVEL,
+        cut_width_mult: float = CUT_WIDTH_MULT,
+        start: int = 0) -> tp.Tuple[np.ndarray, int, int, float]:
+    """Get cut parameters for fitting to a peak
+
+    The threshold crossings are searched outwards from the peak,
+    so only the peak region has to be read after finding the peak.
+    Data before the start index is ignored, as if it were zero.
+    Raises IndexError if the peak has no width above the threshold.
+    """
+    if start >= data.size:
+        raise ValueError("Cannot get a cut for empty data")
+    peak_ind = start
+    peak = data[start]
+    for i in range(start + 1, data.size):
+        if data[i] > peak:
+            peak = data[i]
+            peak_ind = i
+
+    threshold = peak * threshold_level
+    first_above = peak_ind
+    while first_above > start and data[first_above - 1] > threshold:
+        first_above -= 1
+    last_above = peak_ind
+    while last_above < data.size - 1 and data[last_above + 1] > threshold:
+        last_above += 1
+
+    threshold_width = last_above - first_above
+    # A peak without width cannot be fit, and the callers handle IndexError as a failed fit
+    if not peak > threshold or threshold_width == 0:
+        raise IndexError("No data above the threshold around the peak")
+    cut_ind_min = int(round(max(0, peak_ind - cut_width_mult * (peak_ind - first_above))))
+    cut_ind_max = int(round(min(data.size, peak_ind + cut_width_mult * (last_above - peak_ind) + 1)))
+    cut_inds = np.arange(cut_ind_min, cut_ind_max)
+
+    return cut_inds, threshold_width, peak_ind, peak
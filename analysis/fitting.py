@@ -1,18 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import os
+import threading
 import typing as tp
 
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.odr
-from scipy.optimize import curve_fit
+from scipy.optimize import least_squares
 
+from cuts import CUT_WIDTH_MULT, THRESHOLD_LEVEL, get_cut
 from devices.mca import MeasMCA
 import plot
 import stats
 import type_hints
 
-# Adjusting these may result in failed fits
-THRESHOLD_LEVEL = 0.5
-CUT_WIDTH_MULT = 1.7
+# The MINPACK and ODRPACK wrappers of older SciPy versions, including the 1.6 series allowed by requirements.txt,
+# store the Python fitting functions in global variables. Therefore only one thread may run a solver at a time.
+FIT_LOCK = threading.Lock()
+# Gaussian fits are plotted only within this many standard deviations from the mean
+FIT_PLOT_STDS = 6
 
 
 # Functions to be fit
@@ -25,53 +32,57 @@ def poly2(x, a, b, c):
     return a*x**2 + b*x + c
 
 
+# Jacobians of the functions to be fit
+
+def poly1_jac(x, a, b):
+    return np.column_stack([x, np.ones_like(x)])
+
+
+def poly2_jac(x, a, b, c):
+    return np.column_stack([x**2, x, np.ones_like(x)])
+
+
 # Other functions
 
 def create_subplot_grid(
         num_plots: int,
         grid_aspect_ratio: float = 1,
         xlabel: str = None,
-        ylabel: str = None) -> tp.Tuple[plt.Figure, tp.List[plt.Axes], int, int]:
+        ylabel: str = None) -> tp.Tuple[plt.Figure, np.ndarray, int, int]:
     """Create a figure with a grid of subplots"""
     fig: plt.Figure
     num_plots_x = int(np.sqrt(num_plots)*grid_aspect_ratio)
     num_plots_y = int(np.ceil(num_plots / num_plots_x))
     fig, axes = plt.subplots(num_plots_y, num_plots_x)
-    axes_flat: tp.List[plt.Axes] = [item for sublist in axes for item in sublist]
+    # plt.subplots returns a single Axes or a 1D array for a single row or column
+    axes_flat: np.ndarray = np.asarray(axes).reshape(-1)
 
     # Remove unnecessary axes
     for ax in axes_flat[num_plots:]:
         fig.delaxes(ax)
 
-    for i, ax in enumerate(axes_flat):
-        if xlabel is not None:
-            if num_plots - i <= num_plots_x:
+    if xlabel is not None:
+        inds = np.arange(num_plots)
+        bottom_row = inds >= num_plots - num_plots_x
+        left_col = inds % num_plots_x == 0
+        for ax, bottom, left in zip(axes_flat, bottom_row, left_col):
+            if bottom:
                 ax.set_xlabel(xlabel)
-            else:
-                ax.xaxis.set_ticklabels([])
-
-            if i % num_plots_x == 0:
+            if left:
                 ax.set_ylabel(ylabel)
-            else:
-                ax.yaxis.set_ticklabels([])
+            ax.tick_params(labelbottom=bool(bottom), labelleft=bool(left))
 
     return fig, axes_flat, num_plots_x, num_plots_y
 
 
-def get_cut(
-        data: np.ndarray,
-        threshold_level: float = THRESHOLD_LEVEL,
-        cut_width_mult: float = CUT_WIDTH_MULT) -> tp.Tuple[np.ndarray, int, int, float]:
-    """Get cut parameters for fitting to a peak"""
-    peak_ind: int = np.argmax(data)
-    peak = data[peak_ind]
-    threshold_inds = np.where(data > peak * threshold_level)[0]
-    threshold_width = threshold_inds[-1] - threshold_inds[0]
-    cut_ind_min = int(round(max(0, peak_ind - cut_width_mult * (peak_ind - threshold_inds[0]))))
-    cut_ind_max = int(round(min(data.size, peak_ind + cut_width_mult * (threshold_inds[-1] - peak_ind) + 1)))
-    cut_inds = np.arange(cut_ind_min, cut_ind_max)
-
-    return cut_inds, threshold_width, peak_ind, peak
+def get_scan_limits(mcas: tp.List[MeasMCA]) -> tp.Tuple[int, int]:
+    """Get the highest count and the last channel of a set of MCA measurements"""
+    # The counts are stacked to a zero-padded 2D array so that the reductions are single NumPy calls
+    num_channels = max(mca.counts.size for mca in mcas)
+    counts = np.zeros((len(mcas), num_channels), dtype=mcas[0].counts.dtype)
+    for i, mca in enumerate(mcas):
+        counts[i, :mca.counts.size] = mca.counts
+    return counts.max(), num_channels - 1
 
 
 def fit_am(
@@ -87,30 +98,61 @@ def fit_am(
     else:
         counts = mca.counts
 
+    fit, cut_inds, peak = fit_am_peak(mca, counts, threshold_level, cut_width_mult)
+    plot_am_fit(mca, ax, fit, cut_inds, peak, vlines=vlines)
+    return fit
+
+
+def fit_am_peak(
+        mca: MeasMCA,
+        counts: np.ndarray,
+        threshold_level: float = THRESHOLD_LEVEL,
+        cut_width_mult: float = CUT_WIDTH_MULT) -> tp.Tuple[type_hints.CURVE_FIT, np.ndarray, float]:
+    """Fit the main peak of an Am-241 spectrum without plotting
+
+    :return: fit, cut indices and peak height
+    """
     peak = np.max(counts)
     above_threshold = np.where(counts > threshold_level * peak)[0]
     half_ind = (above_threshold[0] + above_threshold[-1]) // 2
-    filtered = counts.copy()
-    filtered[:half_ind] = 0
-    # ax.plot(filtered)
 
-    cut_inds, threshold_width, peak_ind, peak = get_cut(filtered, threshold_level, cut_width_mult)
+    cut_inds, threshold_width, peak_ind, peak = get_cut(counts, threshold_level, cut_width_mult, start=half_ind)
+    fit = fit_mca_gaussian(mca, cut_inds, counts[cut_inds], peak, peak_ind, threshold_width)
+    return fit, cut_inds, peak
+
 
+def plot_am_fit(
+        mca: MeasMCA,
+        ax: plt.Axes,
+        fit: type_hints.CURVE_FIT,
+        cut_inds: np.ndarray,
+        peak: float,
+        vlines: bool = True):
+    """Plot an Am-241 fit and its cuts"""
     # Vertical lines according to the cuts
     if vlines:
         # ax.scatter(peak_ind, peak, color="r")
         ax.vlines((cut_inds[0], cut_inds[-1]), ymin=0, ymax=peak, label="fit cut", colors="r", linestyles=":")
+    plot_gaussian_fit(mca, ax, fit)
 
-    fit = fit_mca_gaussian(mca, cut_inds, counts[cut_inds], peak, peak_ind, threshold_width)
 
+def gaussian_window(channels: np.ndarray, coeff: np.ndarray, num_stds: float = FIT_PLOT_STDS) -> slice:
+    """Get the range of the sorted channels where a fitted Gaussian is distinguishable from zero"""
+    mu = coeff[1]
+    sigma = coeff[2]
+    start, stop = np.searchsorted(channels, (mu - num_stds*sigma, mu + num_stds*sigma))
+    return slice(start, stop)
+
+
+def plot_gaussian_fit(mca: MeasMCA, ax: plt.Axes, fit: type_hints.CURVE_FIT, label: str = "Fe-55 fit"):
+    """Plot a Gaussian fit near its peak"""
+    channels = mca.channels[gaussian_window(mca.channels, fit[0])]
     ax.plot(
-        mca.channels,
-        stats.gaussian_scaled_odr(fit[0], mca.channels),
-        # fit[0][0] * stats.gaussian(mca.channels, *fit[0][1:]),
+        channels,
+        stats.gaussian_scaled_odr(fit[0], channels),
         linestyle="--",
-        label="Fe-55 fit"
+        label=label
     )
-    return fit
 
 
 def fit_am_hv_scan(
@@ -125,20 +167,25 @@ def fit_am_hv_scan(
     if fig_titles:
         fig.suptitle("Am fits")
 
-    max_peak_height = np.max([np.max(mca.counts) for mca in mcas])
-    max_ch = np.max([mca.channels[-1] for mca in mcas])
+    max_peak_height, max_ch = get_scan_limits(mcas)
     y_adjust_step = 50
     max_peak_height_round = y_adjust_step * np.ceil(max_peak_height/y_adjust_step)
 
-    fits = []
-    for i, mca in enumerate(mcas):
-        ax = axes[i]
-        ax.plot(mca.counts)
-        ax.set_xlim(0, max_ch)
-        ax.set_ylim(0, max_peak_height_round)
-        ax.text(0.05, 0.8, f"V={voltages[i]} V, g={gains[i]}", transform=ax.transAxes, fontdict={"size": 8})
-
-        fits.append(fit_am(mca, ax, vlines=vlines))
+    # The fits are computed in worker threads, since Matplotlib has to be used from the main thread.
+    # The solvers themselves are serialized by FIT_LOCK.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(fit_am_peak, mca, mca.counts) for mca in mcas]
+        fits: tp.List[type_hints.CURVE_FIT] = [None] * len(mcas)
+        for i, (mca, voltage, gain) in enumerate(zip(mcas, voltages.tolist(), gains.tolist())):
+            ax = axes[i]
+            ax.plot(mca.counts)
+            ax.set_xlim(0, max_ch)
+            ax.set_ylim(0, max_peak_height_round)
+            ax.text(0.05, 0.8, f"V={voltage} V, g={gain}", transform=ax.transAxes, fontdict={"size": 8})
+
+            fit, cut_inds, peak = futures[i].result()
+            plot_am_fit(mca, ax, fit, cut_inds, peak, vlines=vlines)
+            fits[i] = fit
 
     plot.save_fig(fig, "am_scan_fits")
     return fits
@@ -162,16 +209,9 @@ def fit_fe(
     else:
         counts = mca.counts
 
-    cut_inds, threshold_width, peak_ind, peak = get_cut(counts, threshold_level, cut_width_mult)
-
-    fit = fit_mca_gaussian(mca, cut_inds, counts[cut_inds], peak, peak_ind, threshold_width)
+    fit, cut_inds, peak = fit_fe_peak(mca, counts, threshold_level, cut_width_mult)
     if not secondary:
-        ax.plot(
-            mca.channels,
-            fit[0][0] * stats.gaussian(mca.channels, *fit[0][1:]),
-            linestyle="--",
-            label="Fe-55 fit"
-        )
+        plot_gaussian_fit(mca, ax, fit)
         return fit
 
     # The secondary peak is the Argon escape peak and therefore not a property of the Fe-55 source itself
@@ -181,17 +221,36 @@ def fit_fe(
     fit2 = fit_mca_gaussian(mca, cut_inds2, counts[cut_inds2], peak2, peak_ind2, threshold_width2)
     # print("fit:", fit)
     # print("fit2:", fit2)
-    fit1_data = fit[0][0] * stats.gaussian(mca.channels, *fit[0][1:])
-    fit2_data = fit2[0][0] * stats.gaussian(mca.channels, *fit2[0][1:])
+    windows = (gaussian_window(mca.channels, fit[0]), gaussian_window(mca.channels, fit2[0]))
+    start = min(window.start for window in windows)
+    stop = max(window.stop for window in windows)
+    # Each Gaussian is evaluated only within its own window and summed into a shared buffer
+    fit_data = np.zeros(stop - start)
+    for coeff, window in zip((fit[0], fit2[0]), windows):
+        fit_data[window.start - start:window.stop - start] += stats.gaussian_scaled_odr(coeff, mca.channels[window])
     ax.plot(
-        mca.channels,
-        fit1_data + fit2_data,
+        mca.channels[start:stop],
+        fit_data,
         linestyle="--",
         label="Fe-55 fit",
     )
     return fit, fit2
 
 
+def fit_fe_peak(
+        mca: MeasMCA,
+        counts: np.ndarray,
+        threshold_level: float = THRESHOLD_LEVEL,
+        cut_width_mult: float = CUT_WIDTH_MULT) -> tp.Tuple[type_hints.CURVE_FIT, np.ndarray, float]:
+    """Fit the main peak of an Fe-55 spectrum without plotting
+
+    :return: fit, cut indices and peak height
+    """
+    cut_inds, threshold_width, peak_ind, peak = get_cut(counts, threshold_level, cut_width_mult)
+    fit = fit_mca_gaussian(mca, cut_inds, counts[cut_inds], peak, peak_ind, threshold_width)
+    return fit, cut_inds, peak
+
+
 def fit_fe_hv_scan(
         mcas: tp.List[MeasMCA],
         voltages: np.ndarray,
@@ -211,38 +270,42 @@ def fit_fe_hv_scan(
     # peak_channels = np.zeros(len(mcas))
     # fit_stds = np.zeros_like(peak_channels)
 
-    max_peak_height = np.max([np.max(mca.counts) for mca in mcas])
-    max_ch = np.max([mca.channels[-1] for mca in mcas])
+    max_peak_height, max_ch = get_scan_limits(mcas)
     y_adjust_step = 50
     max_peak_height_round = y_adjust_step * np.ceil(max_peak_height/y_adjust_step)
 
-    fits = []
-    for i, mca in enumerate(mcas):
-        ax = axes[i]
-        ax.plot(mca.counts)
-
-        ax.set_xlim(0, max_ch)
-        ax.set_ylim(0, max_peak_height_round)
-        ax.text(0.05, 0.8, f"V={voltages[i]} V, g={gains[i]}", transform=ax.transAxes, fontdict={"size": 8})
-
-        fit = fit_fe(mca, ax, threshold_level, cut_width_mult, secondary=False, vlines=vlines)
-
-        # Double Gaussian fitting is too error-prone
-        # fit = curve_fit(
-        #     stats.double_gaussian,
-        #     cut_inds,
-        #     mca.data[cut_inds],
-        #     # p0=2*(peak/2, peak_ind, threshold_width)
-        # )
-        # if fit[0][0] > fit[0][3]:
-        #     better_fit = fit[0][:3]
-        # else:
-        #     better_fit = fit[0][3:]
-        # ax.plot(mca.channels, better_fit[0]*stats.gaussian(mca.channels, *better_fit[1:]))
-
-        # peak_channels[i] = fit[0][1]
-        # fit_stds[i] = fit[0][2]
-        fits.append(fit)
+    # The fits are computed in worker threads, since Matplotlib has to be used from the main thread.
+    # The solvers themselves are serialized by FIT_LOCK.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(fit_fe_peak, mca, mca.counts, threshold_level, cut_width_mult) for mca in mcas]
+        fits: tp.List[type_hints.CURVE_FIT] = [None] * len(mcas)
+        for i, (mca, voltage, gain) in enumerate(zip(mcas, voltages.tolist(), gains.tolist())):
+            ax = axes[i]
+            ax.plot(mca.counts)
+
+            ax.set_xlim(0, max_ch)
+            ax.set_ylim(0, max_peak_height_round)
+            ax.text(0.05, 0.8, f"V={voltage} V, g={gain}", transform=ax.transAxes, fontdict={"size": 8})
+
+            fit = futures[i].result()[0]
+            plot_gaussian_fit(mca, ax, fit)
+
+            # Double Gaussian fitting is too error-prone
+            # fit = curve_fit(
+            #     stats.double_gaussian,
+            #     cut_inds,
+            #     mca.data[cut_inds],
+            #     # p0=2*(peak/2, peak_ind, threshold_width)
+            # )
+            # if fit[0][0] > fit[0][3]:
+            #     better_fit = fit[0][:3]
+            # else:
+            #     better_fit = fit[0][3:]
+            # ax.plot(mca.channels, better_fit[0]*stats.gaussian(mca.channels, *better_fit[1:]))
+
+            # peak_channels[i] = fit[0][1]
+            # fit_stds[i] = fit[0][2]
+            fits[i] = fit
 
     plot.save_fig(fig, "fe_scan_fits")
 
@@ -272,12 +335,7 @@ def fit_manual(
         ax.vlines((cut_inds[0], cut_inds[-1]), ymin=0, ymax=peak, label="fit cut", colors="r", linestyles=":")
 
     fit = fit_mca_gaussian(mca, cut_inds, counts[cut_inds], peak, peak_ind, threshold_width)
-    ax.plot(
-        mca.channels,
-        fit[0][0] * stats.gaussian(mca.channels, *fit[0][1:]),
-        linestyle="--",
-        label="Fe-55 fit"
-    )
+    plot_gaussian_fit(mca, ax, fit)
     return fit
 
 
@@ -287,22 +345,38 @@ def fit_odr(
         std_x: tp.Union[float, np.ndarray] = None,
         std_y: np.ndarray = None,
         p0: tp.Union[tuple, np.ndarray] = None,
+        jac: callable = None,
+        maxit: int = 15,
+        partol: float = 1e-4,
+        sstol: float = 1e-4,
         debug: bool = False) -> type_hints.CURVE_FIT:
     """Generic ODR fitting
 
     Fitting function should have parameters of the form x, coeff1, coeff2 etc.
+    The optional Jacobian should have the same parameters as the fitting function.
+    If there are no x errors, the least squares result is returned without ODR.
+
+    ODR starts from the least squares result, so it usually converges in a few iterations.
+    Therefore its stopping criteria are looser than the ODRPACK defaults.
+
+    :param maxit: maximum number of ODR iterations
+    :param partol: relative change in the parameters at which ODR is considered converged
+    :param sstol: relative change in the sum of squares at which ODR is considered converged
     """
-    fit = curve_fit(func, x, y, p0=p0, sigma=std_y)
+    fit = fit_least_squares(func, x, y, std_y=std_y, p0=p0, jac=jac)
     if np.any(np.isinf(fit[1])):
         print("Warning! Least squares covariances could not be estimated. This may indicate a failed fit!")
+    if std_x is None or not np.any(std_x):
+        return fit[0], fit[1]
 
     def func_odr(coeff, x):
         return func(x, *coeff)
 
     model = scipy.odr.Model(func_odr)
     data = scipy.odr.RealData(x=x, y=y, sx=std_x, sy=std_y)
-    odr = scipy.odr.ODR(data, model, beta0=fit[0])
-    out = odr.run()
+    odr = scipy.odr.ODR(data, model, beta0=fit[0], maxit=maxit, partol=partol, sstol=sstol)
+    with FIT_LOCK:
+        out = odr.run()
     if debug:
         out.pprint()
     coeff = out.beta
@@ -310,7 +384,7 @@ def fit_odr(
     if not np.any(coeff_covar):
         print(
             "Warning! The ODR covariances could not be estimated, "
-            "so reverting back to curve_fit results (both parameters and covariances)."
+            "so reverting back to least squares results (both parameters and covariances)."
         )
         coeff = fit[0]
         coeff_covar = fit[1]
@@ -318,6 +392,68 @@ def fit_odr(
     return coeff, coeff_covar
 
 
+def fit_least_squares(
+        func: callable,
+        x: np.ndarray, y: np.ndarray,
+        std_y: np.ndarray = None,
+        p0: tp.Union[tuple, np.ndarray] = None,
+        jac: callable = None) -> type_hints.CURVE_FIT:
+    """Weighted least squares fitting with the Levenberg-Marquardt algorithm
+
+    This calls scipy.optimize.least_squares directly instead of going through curve_fit,
+    but the parameters and the result are in the same format as for curve_fit.
+    Failed fits raise RuntimeError, as with curve_fit.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if p0 is None:
+        p0 = np.ones(len(inspect.signature(func).parameters) - 1)
+    std_y = np.broadcast_to(1. if std_y is None else np.asarray(std_y, dtype=float), y.shape)
+    # E.g. channels with zero counts have zero errors, which would result in infinite weights.
+    # Such points are left out of the fit by giving them zero weight.
+    valid_std_y = np.isfinite(std_y) & (std_y > 0)
+    if np.count_nonzero(valid_std_y) < len(p0):
+        raise RuntimeError("Optimal parameters not found: too few data points with positive and finite y errors")
+    if not np.all(valid_std_y):
+        print("Warning! Some y errors are zero or not finite. Leaving these data points out of the fit.")
+    weights = np.zeros(y.shape)
+    weights[valid_std_y] = 1 / std_y[valid_std_y]
+
+    def residuals(coeff):
+        return (func(x, *coeff) - y) * weights
+
+    if jac is None:
+        jac_residuals = "2-point"
+    else:
+        def jac_residuals(coeff):
+            return jac(x, *coeff) * weights[:, np.newaxis]
+
+    # Same evaluation limit as in curve_fit
+    max_nfev = (100 if jac is not None else 200) * (len(p0) + 1)
+    try:
+        with FIT_LOCK:
+            res = least_squares(
+                residuals, p0, jac=jac_residuals,
+                method="lm", x_scale="jac", ftol=1e-6, xtol=1e-6, max_nfev=max_nfev)
+    except ValueError as e:
+        raise RuntimeError(f"Optimal parameters not found: {e}") from e
+    if not res.success:
+        raise RuntimeError(f"Optimal parameters not found: {res.message}")
+
+    # The covariance is estimated as in curve_fit, using the pseudoinverse of J^T J
+    _, sing_vals, vt = np.linalg.svd(res.jac, full_matrices=False)
+    threshold = np.finfo(float).eps * max(res.jac.shape) * sing_vals[0]
+    vt = vt[:np.count_nonzero(sing_vals > threshold)]
+    sing_vals = sing_vals[:vt.shape[0]]
+    coeff_covar = (vt.T / sing_vals**2) @ vt
+    dof = y.size - res.x.size
+    if dof > 0:
+        coeff_covar *= 2*res.cost / dof
+    else:
+        coeff_covar.fill(np.inf)
+    return res.x, coeff_covar
+
+
 def fit_mca_gaussian(
         mca: MeasMCA, inds: np.ndarray, counts: np.ndarray,
         peak: float = None, peak_ind: float = None, threshold_width: float = None) -> type_hints.CURVE_FIT:
@@ -334,11 +470,14 @@ def fit_mca_gaussian(
         std_x=mca.diff_nonlin,
         std_y=mca.int_nonlin * counts,
         p0=(peak, peak_ind, 0.4*threshold_width),
+        jac=stats.gaussian_scaled_jac,
     )
 
 
 def poly2_fit_text(fit: type_hints.CURVE_FIT, prec: str = "3e", err_prec: str = "3e") -> str:
+    """Equation of a second order polynomial fit with the standard deviations of the coefficients"""
+    stds = np.sqrt(np.diag(fit[1]))
     return \
-        f"{fit[0][0]:.{prec}}±{fit[1][0, 0]:.{err_prec}}x^2 + " \
-        f"{fit[0][1]:.{prec}}±{fit[1][1, 1]:.{err_prec}}x + " \
-        f"{fit[0][2]:.{prec}}±{fit[1][2, 2]:.{err_prec}}"
+        f"{fit[0][0]:.{prec}}±{stds[0]:.{err_prec}}x^2 + " \
+        f"{fit[0][1]:.{prec}}±{stds[1]:.{err_prec}}x + " \
+        f"{fit[0][2]:.{prec}}±{stds[2]:.{err_prec}}"
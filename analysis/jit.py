@@ -0,0 +1,19 @@
+"""
+Optional JIT compilation with Numba
+"""
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def njit(func: callable) -> callable:
+    """Compile the function with Numba if it's available and return it unchanged otherwise
+
+    The NumPy error model makes e.g. division by zero give inf or NaN instead of raising,
+    so that the compiled function behaves the same as the plain NumPy one.
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, error_model="numpy")(func)
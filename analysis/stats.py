@@ -2,9 +2,13 @@
 Statistical distributions and related functions
 """
 
-# import numba
+import math
+
 import numpy as np
-import scipy.stats
+
+from jit import njit
+
+SQRT_2PI = math.sqrt(2*math.pi)
 
 
 # Distributions
@@ -14,20 +18,42 @@ def exp_fit(x, slope, offset):
     return np.exp(slope*x + offset)
 
 
-# @numba.njit
+@njit
 def gaussian(x, mu, sigma):
-    return scipy.stats.norm.pdf(x, mu, sigma)
+    """Probability density function of the normal distribution
 
+    This is written out instead of using scipy.stats.norm.pdf,
+    since it's evaluated on every iteration of the fits.
+    As with scipy.stats.norm.pdf, the result is NaN for a non-positive sigma.
+    """
+    if not sigma > 0:
+        sigma = np.nan
+    return np.exp(-0.5*((x - mu)/sigma)**2) / (sigma*SQRT_2PI)
 
-# @numba.njit
+
+@njit
 def gaussian_double(x, a1, m1, s1, a2, m2, s2):
     """Sum of two Gaussians"""
     return a1*gaussian(x, m1, s1) + a2*gaussian(x, m2, s2)
 
 
-# @numba.njit
+@njit
 def gaussian_scaled(x, a, mu, sigma):
-    return a*scipy.stats.norm.pdf(x, mu, sigma)
+    return a*gaussian(x, mu, sigma)
+
+
+@njit
+def gaussian_scaled_jac(x, a, mu, sigma):
+    """Jacobian of gaussian_scaled with respect to its parameters"""
+    if not sigma > 0:
+        sigma = np.nan
+    pdf = gaussian(x, mu, sigma)
+    diff = x - mu
+    jac = np.empty((x.size, 3))
+    jac[:, 0] = pdf
+    jac[:, 1] = a*pdf*diff/sigma**2
+    jac[:, 2] = a*pdf*(diff**2/sigma**3 - 1/sigma)
+    return jac
 
 
 def gaussian_scaled_odr(coeff: np.ndarray, x):